@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import urllib.request
+from itertools import count
+
+WORK_DIR = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("JOBS_DB", os.path.join(WORK_DIR, "jobs.db"))
+os.environ.setdefault("CACHE_DIR", os.path.join(WORK_DIR, "cache"))
+os.environ.setdefault("INSTAGRAM_SESSION_DIR", os.path.join(WORK_DIR, "sessions"))
+os.environ["BOT_TOKEN"] = ""
+
+import main
+from aiohttp import web, ClientSession
+
+PLATFORMS = ("youtube", "tiktok", "pinterest", "stories")
+STATUS_TEXT = "⏳"
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class FakeCdn:
+    def __init__(self, sizes: list, latency: float):
+        self.latency = latency
+        self.files = {}
+        for size in sizes:
+            path = os.path.join(WORK_DIR, f"media-{size}.mp4")
+            with open(path, 'wb') as f:
+                remaining = size
+                while remaining:
+                    chunk = os.urandom(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            self.files[size] = path
+        self.app = web.Application()
+        self.app.add_routes([web.get('/media/{size}/{name}', self.media), web.post('/download.php', self.resolver)])
+        self.base = None
+
+    async def start(self):
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        self.base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        return runner
+
+    def url(self, size: int, name: str = "vid.mp4") -> str:
+        return f"{self.base}/media/{size}/{name}"
+
+    async def media(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        return web.FileResponse(self.files[int(request.match_info['size'])])
+
+    async def resolver(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        link = (await request.post())['url']
+        size = random.choice(list(self.files))
+        href = self.url(size, f"{abs(hash(link))}.mp4")
+        return web.Response(text=f'<table class="table-condensed"><tbody><tr><td><a href="{href}">dl</a></td></tr></tbody></table>', content_type='text/html')
+
+class FakeMedia:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+
+class FakeSent:
+    def __init__(self, message_id: int, video: bool = True):
+        self.id = message_id
+        self.video = FakeMedia(f"file-{message_id}") if video else None
+        self.photo = None if video else FakeMedia(f"file-{message_id}")
+        self.document = self.animation = None
+
+class FakeBot:
+    def __init__(self, upload_bandwidth: float):
+        self.upload_bandwidth = upload_bandwidth
+        self.ids = count(1)
+        self.done = {}
+        self.errors = 0
+        self.copied = 0
+
+    async def upload(self, path: str, progress=None) -> FakeSent:
+        total = os.path.getsize(path)
+        sent = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(512 * 1024)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                self.copied += len(chunk)
+                if self.upload_bandwidth:
+                    await asyncio.sleep(len(chunk) / self.upload_bandwidth)
+                if progress:
+                    await progress(sent, total)
+        return FakeSent(next(self.ids))
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        pass
+
+    async def delete_messages(self, chat_id, message_ids):
+        event = self.done.get(chat_id)
+        if event:
+            event.set()
+
+    async def get_messages(self, chat_id, message_ids):
+        raise RuntimeError("messages are kept in memory during benchmarks")
+
+    async def send_video(self, chat_id, video, **kwargs):
+        return await self.upload(video)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self.upload(photo)
+
+    async def send_cached_media(self, chat_id, file_id, **kwargs):
+        return FakeSent(next(self.ids))
+
+    async def send_media_group(self, chat_id, media):
+        return [FakeSent(next(self.ids)) for _ in media]
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, user_id: int, text: str):
+        self.bot = bot
+        self.id = next(bot.ids)
+        self.text = text
+        self.entities = None
+        self.from_user = type("User", (), {"id": user_id})()
+        self.chat = type("Chat", (), {"id": user_id})()
+
+    async def reply_text(self, text: str):
+        if not text.startswith(STATUS_TEXT):
+            self.bot.errors += 1
+        return FakeSent(next(self.bot.ids))
+
+    async def reply_video(self, video, progress=None, **kwargs):
+        return await self.bot.upload(video, progress)
+
+    async def reply_photo(self, photo, progress=None, **kwargs):
+        return await self.bot.upload(photo, progress)
+
+    async def reply_cached_media(self, file_id, **kwargs):
+        return FakeSent(next(self.bot.ids))
+
+    async def reply_media_group(self, media):
+        return [await self.bot.upload(item.media) for item in media]
+
+def install_stubs(cdn: FakeCdn, args):
+    sizes = list(cdn.files)
+
+    def probe(url: str) -> dict:
+        time.sleep(args.extract_latency)
+        size = sizes[hash(url) % len(sizes)]
+        return {'id': url, 'webpage_url': url, 'formats': [{'format_id': '18', 'url': cdn.url(size), 'protocol': 'http', 'filesize': size, 'vcodec': 'avc1', 'acodec': 'mp4a'}]}
+
+    def download(info: dict, format_id: str, temp_dir: str, reporter=None, limit: int = None) -> main.MediaFile:
+        path = f"{temp_dir}/vid.mp4"
+        with urllib.request.urlopen(info['formats'][0]['url']) as response, open(path, 'wb') as f:
+            shutil.copyfileobj(response, f, 256 * 1024)
+        bot.copied += os.path.getsize(path)
+        media = main.MediaFile(path, temp_dir)
+        media.info = info
+        return media
+
+    def story_items(username: str, highlights: bool) -> list:
+        time.sleep(args.extract_latency)
+        return [(cdn.url(random.choice(sizes), f"{username}-{i}.mp4"), True) for i in range(args.album_size)]
+
+    copy_body = main.http._copy
+    link_or_copy = main.link_or_copy
+
+    async def counted_copy(response, fd: int, position: list, advance, *args):
+        start = position[0]
+        try:
+            await copy_body(response, fd, position, advance, *args)
+        finally:
+            bot.copied += position[0] - start
+
+    def counted_link_or_copy(src: str, dst: str):
+        link_or_copy(src, dst)
+        if os.stat(src).st_ino != os.stat(dst).st_ino:
+            bot.copied += os.path.getsize(dst)
+
+    bot = FakeBot(args.upload_bandwidth)
+    main._ytdlp_probe = probe
+    main._ytdlp_download = download
+    main._instagram_story_items = story_items
+    main.PINTEREST_RESOLVER = f"{cdn.base}/download.php"
+    main.rate_limiter = main.RateLimiter(main.MemoryRateBackend(), 10 ** 9, {}, 10 ** 9)
+    main.http._copy = counted_copy
+    main.link_or_copy = counted_link_or_copy
+    main.bot = bot
+    return bot
+
+def make_urls(args) -> list:
+    templates = {
+        "youtube": "https://www.youtube.com/watch?v={:011d}",
+        "tiktok": "https://www.tiktok.com/@bench/video/{}",
+        "pinterest": "https://www.pinterest.com/pin/{}/",
+        "stories": "https://www.instagram.com/stories/bench{}/",
+    }
+    platforms = args.platforms.split(",")
+    distinct = args.distinct or args.requests
+    return [templates[platforms[i % len(platforms)]].format(i % distinct) for i in range(args.requests)]
+
+async def drive(urls: list, concurrency: int, request) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i: int, url: str):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await request(i, url)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                failures += 1
+                print(f"request {url} failed: {e}", file=sys.stderr)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i, url) for i, url in enumerate(urls)))
+    return latencies, failures, time.perf_counter() - start
+
+async def bench_telegram(bot: FakeBot, urls: list, args) -> tuple:
+    workers = asyncio.ensure_future(main.job_queue.run(main.process_job, args.workers))
+    user_ids = count(1_000_000)
+
+    async def request(i: int, url: str):
+        message = FakeMessage(bot, next(user_ids), url)
+        event = bot.done[message.chat.id] = asyncio.Event()
+        errors = bot.errors
+        try:
+            await main.handle_message(None, message)
+            await asyncio.wait_for(event.wait(), timeout=args.timeout)
+        finally:
+            bot.done.pop(message.chat.id, None)
+        if bot.errors != errors:
+            raise RuntimeError("error reply")
+
+    try:
+        return await drive(urls, args.concurrency, request)
+    finally:
+        workers.cancel()
+
+async def bench_web(urls: list, args) -> tuple:
+    runner = web.AppRunner(main.web_app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    endpoint = f"http://127.0.0.1:{runner.addresses[0][1]}/download"
+    try:
+        async with ClientSession() as session:
+            async def request(i: int, url: str):
+                async with session.post(endpoint, json={'url': url}) as response:
+                    body = await response.read()
+                    if response.status != 200 or not body:
+                        raise RuntimeError(f"HTTP {response.status}")
+            return await drive(urls, args.concurrency, request)
+    finally:
+        await runner.cleanup()
+
+def summarize(name: str, latencies: list, failures: int, elapsed: float, heap_peak: int, concurrency: int, copied: int) -> dict:
+    return {
+        "target": name,
+        "requests": len(latencies) + failures,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "heap_peak_bytes": heap_peak,
+        "heap_peak_per_inflight_request": heap_peak // max(concurrency, 1),
+        "bytes_copied_per_request": copied // max(len(latencies) + failures, 1),
+    }
+
+def compare(results: list, peak_rss_mb: float, baseline_path: str):
+    with open(baseline_path, "r") as f:
+        data = json.load(f)
+    baseline = {r["target"]: r for r in data["results"]}
+    if data.get("process_peak_rss_mb"):
+        base = data["process_peak_rss_mb"]
+        print(f"\nprocess peak_rss_mb vs baseline: {base:.1f} -> {peak_rss_mb:.1f} ({(peak_rss_mb - base) * 100 / base:+.1f}%)")
+    for result in results:
+        base = baseline.get(result["target"])
+        if not base:
+            continue
+        print(f"\n{result['target']} vs baseline:")
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "heap_peak_per_inflight_request", "bytes_copied_per_request"):
+            if base.get(metric):
+                print(f"  {metric:32} {base[metric]:>12.1f} -> {result[metric]:>12.1f} ({(result[metric] - base[metric]) * 100 / base[metric]:+.1f}%)")
+
+async def run(args) -> list:
+    sizes = [int(float(s) * 1024 * 1024) for s in args.sizes.split(",")]
+    cdn = FakeCdn(sizes, args.cdn_latency)
+    runner = await cdn.start()
+    bot = install_stubs(cdn, args)
+    results = []
+    try:
+        for target in args.targets.split(","):
+            shutil.rmtree(main.media_cache.directory, ignore_errors=True)
+            main.media_cache = main.MediaCache(main.media_cache.directory, main.CACHE_MAX_BYTES if args.cache else 0, main.CACHE_TTL)
+            main.probe_cache.clear()
+            urls = make_urls(args)
+            bot.copied = 0
+            if args.trace_alloc:
+                tracemalloc.start()
+            if target == "telegram":
+                latencies, failures, elapsed = await bench_telegram(bot, urls, args)
+            else:
+                latencies, failures, elapsed = await bench_web(urls, args)
+            heap_peak = tracemalloc.get_traced_memory()[1] if args.trace_alloc else 0
+            tracemalloc.stop()
+            results.append(summarize(target, latencies, failures, elapsed, heap_peak, args.concurrency, bot.copied))
+    finally:
+        await main.http.close()
+        await runner.cleanup()
+    return results
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load-test the download pipeline against local stand-ins.")
+    parser.add_argument("--targets", default="telegram,web", help="comma separated: telegram, web")
+    parser.add_argument("--platforms", default="youtube,tiktok,pinterest,stories", help=f"comma separated subset of {', '.join(PLATFORMS)}")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--distinct", type=int, default=0, help="number of distinct URLs (0 = every request unique)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=main.JOB_WORKERS, help="job queue workers for the telegram target")
+    parser.add_argument("--sizes", default="1,5,20", help="synthetic media sizes in MB")
+    parser.add_argument("--album-size", type=int, default=4)
+    parser.add_argument("--cdn-latency", type=float, default=0.02)
+    parser.add_argument("--extract-latency", type=float, default=0.05)
+    parser.add_argument("--upload-bandwidth", type=float, default=50 * 1024 * 1024, help="simulated Telegram upload bytes/s (0 = unlimited)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--cache", action="store_true", help="keep the on-disk media cache enabled")
+    parser.add_argument("--trace-alloc", action="store_true", help="track Python heap peak with tracemalloc (slower)")
+    parser.add_argument("--output", default="bench_results")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    # ru_maxrss is the high-water mark of the whole process, not of any single target
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for result in results:
+        print(f"\n[{result['target']}]")
+        for metric, value in result.items():
+            if metric != "target":
+                print(f"  {metric:32} {value:>12.1f}" if isinstance(value, float) else f"  {metric:32} {value:>12}")
+    print(f"\n[process]\n  {'peak_rss_mb':32} {peak_rss_mb:>12.1f}")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(path, "w") as f:
+        json.dump({"args": vars(args), "process_peak_rss_mb": peak_rss_mb, "results": results}, f, indent=2)
+    print(f"\nResults saved to {path}")
+    if args.baseline:
+        compare(results, peak_rss_mb, args.baseline)
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,28 +1,87 @@
+import time
+BOOT_STARTED = time.perf_counter()
+
 import os
 import logging
 import tempfile
 import shutil
-from io import BytesIO
-from datetime import datetime, timedelta
-from pyrogram import Client, filters
-from pyrogram.types import Message
-
-def named_bytesio(data: bytes, name: str = "vid.mp4") -> BytesIO:
-    bio = BytesIO(data)
-    bio.name = name
-    return bio
-from yt_dlp import YoutubeDL
-import instaloader
+from pyrogram import Client, filters, idle
+from pyrogram.errors import FloodWait
+from pyrogram.enums import MessageEntityType
+from pyrogram.types import Message, InputMediaPhoto, InputMediaVideo
 import aiohttp
-from pyquery import PyQuery as pq
-import requests
 import json
 from dotenv import load_dotenv
-from flask import Flask, render_template_string, request, send_file, jsonify
+from aiohttp import web
 import threading
 import asyncio
-from apscheduler.schedulers.background import BackgroundScheduler
+import re
+import hashlib
+import hmac
+import secrets
+import random
+import heapq
+import sqlite3
+import contextvars
+import multiprocessing
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from collections import deque, OrderedDict
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor, Future
 import subprocess
+import importlib
+
+startup_timings = {"eager_imports": round(time.perf_counter() - BOOT_STARTED, 3)}
+
+class MediaFile:
+    def __init__(self, path: str, temp_dir: str = None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.temp_dir = temp_dir
+        self.info = None
+        self.thumb = None
+        self.refs = 1
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return os.stat(self.path).st_size
+
+    def acquire(self, count: int = 1):
+        with self.lock:
+            self.refs += count
+
+    def close(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0 or not self.temp_dir:
+                return
+            temp_dir, self.temp_dir = self.temp_dir, None
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+class LazyModule:
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                startup_timings[f"import_{self.name}"] = round(time.perf_counter() - started, 3)
+                logging.info(f"Imported {self.name} in {startup_timings[f'import_{self.name}']}s")
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.module or self.load(), attr)
+
+yt_dlp = LazyModule("yt_dlp")
+instaloader = LazyModule("instaloader")
+pyquery = LazyModule("pyquery")
+BACKENDS = {"yt_dlp": yt_dlp, "instaloader": instaloader, "pyquery": pyquery}
 
 load_dotenv()
 
@@ -30,8 +89,14 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
-FLASK_PORT = int(os.getenv("FLASK_PORT", "5000"))
+CHANNEL_IDS = [int(c) for c in os.getenv("CHANNEL_IDS", CHANNEL_ID or "").split(",") if c.strip()]
+CHANNEL_BACKLOG = int(os.getenv("CHANNEL_BACKLOG", "500"))
+CHANNEL_BATCH_WINDOW = float(os.getenv("CHANNEL_BATCH_WINDOW", "2"))
+WEB_PORT = int(os.getenv("WEB_PORT", os.getenv("FLASK_PORT", "5000")))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+WARMUP_BACKENDS = [name.strip() for name in os.getenv("WARMUP_BACKENDS", "").split(",") if name.strip()]
 PAIR_SITE = os.getenv("PAIR_SITE")
+PINTEREST_RESOLVER = os.getenv("PINTEREST_RESOLVER", "https://www.expertsphp.com/download.php")
 
 COOKIES_FILE = "cookies.txt"
 if not os.path.exists(COOKIES_FILE):
@@ -39,26 +104,947 @@ if not os.path.exists(COOKIES_FILE):
     if cookies_content:
         with open(COOKIES_FILE, 'w') as f:
             f.write(cookies_content)
+YTDLP_COOKIES = COOKIES_FILE if os.path.exists(COOKIES_FILE) else None
 
 MAX_FILE_SIZE = 100 * 1024 * 1024
 MAX_REQUESTS_PER_MINUTE = 5
-user_requests = {}
+GLOBAL_REQUESTS_PER_MINUTE = int(os.getenv("GLOBAL_REQUESTS_PER_MINUTE", "300"))
+PLATFORM_REQUESTS_PER_MINUTE = {k.strip(): int(v) for k, v in (p.split("=") for p in os.getenv("PLATFORM_REQUESTS_PER_MINUTE", "YouTube=120,TikTok=120,Facebook=60,Instagram=60,Pinterest=120").split(",") if p.strip())}
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+TRUST_PROXY = os.getenv("TRUST_PROXY", "").lower() in ("1", "true", "yes")
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv("DOWNLOAD_QUEUE_LIMIT", "32"))
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "10"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+RANGE_PARTS = int(os.getenv("RANGE_PARTS", "4"))
+RANGE_MIN_SIZE = int(os.getenv("RANGE_MIN_SIZE", str(4 * 1024 * 1024)))
+RANGE_RESUMES = int(os.getenv("RANGE_RESUMES", "3"))
+ALBUM_CONCURRENCY = int(os.getenv("ALBUM_CONCURRENCY", "4"))
+MEDIA_GROUP_SIZE = 10
+INSTAGRAM_SESSION_DIR = os.getenv("INSTAGRAM_SESSION_DIR", "sessions")
+INSTAGRAM_COOLDOWN = int(os.getenv("INSTAGRAM_COOLDOWN", "900"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", str(24 * 3600)))
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", "30"))
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "1"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(24 * 3600)))
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "10"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+BATCH_DIR = os.getenv("BATCH_DIR", "batch")
+PROGRESS_INTERVAL = 3
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+PROBE_TTL = int(os.getenv("PROBE_TTL", "600"))
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+TRANSCODE = os.getenv("TRANSCODE", "").lower() in ("1", "true", "yes")
+FFMPEG = os.getenv("FFMPEG", "ffmpeg")
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+TRANSCODE_THREADS = int(os.getenv("TRANSCODE_THREADS", "2"))
+TRANSCODE_NICE = int(os.getenv("TRANSCODE_NICE", "10"))
+TRANSCODE_TIMEOUT = int(os.getenv("TRANSCODE_TIMEOUT", "600"))
+TRANSCODE_SOURCE_LIMIT = int(os.getenv("TRANSCODE_SOURCE_LIMIT", str(4 * MAX_FILE_SIZE)))
+DOWNLOAD_LIMIT = TRANSCODE_SOURCE_LIMIT if TRANSCODE else MAX_FILE_SIZE
+PLATFORM_LIMITS = {k.strip(): int(v) for k, v in (p.split("=") for p in os.getenv("PLATFORM_LIMITS", "YouTube=4,TikTok=4,Facebook=2,Instagram=2").split(",") if p.strip())}
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-app = Flask(__name__)
+routes = web.RouteTableDef()
 bot = Client("bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
-@app.route('/check')
-def check_server_status():
-    return jsonify({"status": "available", "message": "Server is running"})
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "counter")
+            self.values[key] = self.values.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "gauge")
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "histogram")
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def in_flight(self, name: str, **labels):
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def render(self) -> str:
+        def fmt(labels) -> str:
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+        lines = []
+        with self.lock:
+            for name, kind in sorted(self.types.items()):
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (metric, labels), histogram in self.histograms.items():
+                        if metric != name:
+                            continue
+                        cumulative = 0
+                        for bound, bucket in zip(self.buckets, histogram):
+                            cumulative += bucket
+                            lines.append(f"{name}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+                        lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                        lines.append(f"{name}_sum{fmt(labels)} {histogram[-2]}")
+                        lines.append(f"{name}_count{fmt(labels)} {histogram[-1]}")
+                else:
+                    lines += [f"{name}{fmt(labels)} {value}" for (metric, labels), value in self.values.items() if metric == name]
+        return "\n".join(lines) + "\n"
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics(LATENCY_BUCKETS)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+trace_lock = threading.Lock()
+
+@contextmanager
+def stage(name: str, platform: str = "unknown"):
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", duration, stage=name, platform=platform)
+        if error:
+            metrics.inc("stage_errors_total", stage=name, platform=platform)
+        spans = current_trace.get()
+        if spans is not None:
+            spans.append({"stage": name, "platform": platform, "offset": round(start - spans[0], 6), "duration": round(duration, 6), "error": error})
+
+@contextmanager
+def traced(name: str, **attrs):
+    if not TRACE_SAMPLE_RATE or random.random() >= TRACE_SAMPLE_RATE:
+        yield
+        return
+    start = time.perf_counter()
+    spans = [start]
+    token = current_trace.set(spans)
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+        trace = {"trace_id": os.urandom(8).hex(), "name": name, "time": time.time(), "duration": round(time.perf_counter() - start, 6), **attrs, "spans": spans[1:]}
+        with trace_lock, open(TRACE_FILE, "a") as f:
+            f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+class EngineBusy(Exception):
+    pass
+
+class MediaTooLarge(Exception):
+    pass
+
+class DownloadEngine:
+    def __init__(self, workers: int, platform_limits: dict, queue_limit: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.platform_limits = platform_limits
+        self.default_limit = workers
+        self.queue_limit = queue_limit
+        self.lock = threading.Lock()
+        self.active = {}
+        self.pending = {}
+        self.depth = 0
+
+    def submit(self, platform: str, fn, *args) -> Future:
+        future = Future()
+        with self.lock:
+            if self.depth >= self.queue_limit:
+                raise EngineBusy("الخادم مشغول حاليًا، يرجى المحاولة بعد قليل.")
+            self.depth += 1
+            if self.active.get(platform, 0) < self.platform_limits.get(platform, self.default_limit):
+                self.active[platform] = self.active.get(platform, 0) + 1
+                self.executor.submit(self._run, platform, future, fn, args)
+            else:
+                self.pending.setdefault(platform, deque()).append((future, fn, args))
+        return future
+
+    async def run(self, platform: str, fn, *args):
+        future = self.submit(platform, fn, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._close_late_result)
+            raise
+
+    @staticmethod
+    def _close_late_result(future: Future):
+        if not future.cancelled() and future.exception() is None and isinstance(future.result(), MediaFile):
+            future.result().close()
+
+    def _run(self, platform: str, future: Future, fn, args):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self._release(platform)
+
+    def _release(self, platform: str):
+        with self.lock:
+            self.depth -= 1
+            queue = self.pending.get(platform)
+            if queue:
+                future, fn, args = queue.popleft()
+                self.executor.submit(self._run, platform, future, fn, args)
+            else:
+                self.active[platform] -= 1
+
+engine = DownloadEngine(DOWNLOAD_WORKERS, PLATFORM_LIMITS, DOWNLOAD_QUEUE_LIMIT)
+
+class Transcoder:
+    def __init__(self, workers: int, threads: int, nice: int, timeout: int):
+        self.workers = workers
+        self.threads = threads
+        self.nice = nice
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = []
+        self.seq = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        if self.active < self.workers and not self.waiting:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.seq += 1
+            heapq.heappush(self.waiting, (priority, self.seq, future))
+            metrics.add("transcode_queue", 1)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+            finally:
+                metrics.add("transcode_queue", -1)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self.waiting:
+            future = heapq.heappop(self.waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    async def run(self, inputs: list, options: list, output: str, priority: int = 0) -> bool:
+        async with self.slot(priority):
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    FFMPEG, "-hide_banner", "-loglevel", "error", "-y", *inputs, *options, "-threads", str(self.threads), output,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                logging.error(f"Cannot start ffmpeg: {e}")
+                return False
+            try:
+                os.setpriority(os.PRIO_PROCESS, process.pid, self.nice)
+            except OSError:
+                pass
+            try:
+                with metrics.in_flight("transcodes_running"):
+                    _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                logging.error(f"ffmpeg timed out after {self.timeout}s on {output}")
+                return False
+            except BaseException:
+                process.kill()
+                raise
+        if process.returncode:
+            logging.warning(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+        return process.returncode == 0
+
+transcoder = Transcoder(TRANSCODE_WORKERS, TRANSCODE_THREADS, TRANSCODE_NICE, TRANSCODE_TIMEOUT)
+transcode_priority = contextvars.ContextVar("transcode_priority", default=0)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+class HttpClient:
+    def __init__(self, limit: int, limit_per_host: int, timeout: float, retries: int, range_parts: int, range_min_size: int, resumes: int):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=timeout)
+        self.retries = retries
+        self.range_parts = range_parts
+        self.range_min_size = range_min_size
+        self.resumes = resumes
+        self.sessions = {}
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300, keepalive_timeout=30)
+            session = self.sessions[loop] = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.session().request(method, url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    break
+                response.release()
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def text(self, method: str, url: str, **kwargs) -> str:
+        async with self.request(method, url, **kwargs) as response:
+            return await response.text()
+
+    async def resolve(self, url: str) -> str:
+        async with self.request("GET", url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            return str(response.url)
+
+    async def download(self, url: str, path: str, max_bytes: int, reporter=None, on_stream=None) -> int:
+        received = 0
+        total = None
+
+        def advance(count: int):
+            nonlocal received
+            received += count
+            if received > max_bytes:
+                raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+            if reporter:
+                reporter.report("⬇️ جاري التحميل...", received, total)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            async with self.request("GET", url, headers={"Range": "bytes=0-", "Accept-Encoding": "identity"}) as response:
+                response.raise_for_status()
+                match = CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+                if response.status == 206 and match:
+                    total = int(match[3]) if match[3] != "*" else None
+                else:
+                    total = response.content_length
+                ranged = response.status == 206 or response.headers.get("Accept-Ranges") == "bytes"
+                if total is not None and total > max_bytes:
+                    raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+                parallel = ranged and total and total >= self.range_min_size and self.range_parts > 1
+                if not parallel:
+                    if on_stream:
+                        on_stream()
+                    position = [0]
+                    try:
+                        await self._copy(response, fd, position, advance)
+                    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                        if not ranged or total is None:
+                            raise
+                        metrics.inc("download_resumes_total")
+                    if total is not None and position[0] < total:
+                        await self._fetch_range(url, fd, position[0], total - 1, advance)
+            if parallel:
+                try:
+                    os.posix_fallocate(fd, 0, total)
+                except (OSError, AttributeError):
+                    os.ftruncate(fd, total)
+                step = -(-total // self.range_parts)
+                tasks = [asyncio.ensure_future(self._fetch_range(url, fd, start, min(start + step, total) - 1, advance)) for start in range(0, total, step)]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+            if total is not None and (received != total or os.fstat(fd).st_size != total):
+                raise aiohttp.ClientPayloadError(f"Incomplete download: {received} of {total} bytes")
+            return received
+        finally:
+            os.close(fd)
+
+    async def _copy(self, response: aiohttp.ClientResponse, fd: int, position: list, advance, chunk_size: int = 64 * 1024):
+        async for chunk in response.content.iter_chunked(chunk_size):
+            advance(len(chunk))
+            os.pwrite(fd, chunk, position[0])
+            position[0] += len(chunk)
+
+    async def _fetch_range(self, url: str, fd: int, start: int, end: int, advance):
+        position = [start]
+        for attempt in range(self.resumes + 1):
+            try:
+                async with self.request("GET", url, headers={"Range": f"bytes={position[0]}-{end}", "Accept-Encoding": "identity"}) as response:
+                    response.raise_for_status()
+                    match = CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+                    if response.status != 206 or not match or int(match[1]) != position[0] or int(match[2]) > end:
+                        raise ValueError(f"Range request for bytes {position[0]}-{end} was not honoured")
+                    await self._copy(response, fd, position, advance)
+                if position[0] > end:
+                    return
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.resumes:
+                    raise
+            metrics.inc("download_resumes_total")
+        raise aiohttp.ClientPayloadError(f"Incomplete range {start}-{end}")
+
+    async def close(self):
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session:
+            await session.close()
+
+http = HttpClient(HTTP_LIMIT, HTTP_LIMIT_PER_HOST, HTTP_TIMEOUT, HTTP_RETRIES, RANGE_PARTS, RANGE_MIN_SIZE, RANGE_RESUMES)
+
+class MemoryRateBackend:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.tats = OrderedDict()
+
+    async def acquire(self, quotas: list, now: float) -> tuple:
+        with self.lock:
+            updates = []
+            for key, interval, tolerance in quotas:
+                tat = max(self.tats.get(key, now), now)
+                if tat - now > tolerance:
+                    return tat - now - tolerance, key
+                updates.append((key, tat + interval))
+            for key, tat in updates:
+                self.tats[key] = tat
+                self.tats.move_to_end(key)
+            while self.tats and (len(self.tats) > self.max_keys or next(iter(self.tats.values())) <= now):
+                self.tats.popitem(last=False)
+        return 0, None
+
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tats = {}
+for i = 1, #KEYS do
+    local tat = math.max(tonumber(redis.call('GET', KEYS[i]) or now), now)
+    local tolerance = tonumber(ARGV[2 * i + 1])
+    if tat - now > tolerance then
+        return {tostring(tat - now - tolerance), KEYS[i]}
+    end
+    tats[i] = tat + tonumber(ARGV[2 * i])
+end
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], tostring(tats[i]), 'PX', math.ceil((tats[i] - now) * 1000))
+end
+return {'0', ''}
+"""
+
+class RedisRateBackend:
+    def __init__(self, url: str):
+        import redis.asyncio
+        self.redis = redis.asyncio.from_url(url)
+        self.script = self.redis.register_script(GCRA_SCRIPT)
+
+    async def acquire(self, quotas: list, now: float) -> tuple:
+        args = [now]
+        for _, interval, tolerance in quotas:
+            args += [interval, tolerance]
+        retry_after, key = await self.script(keys=[key for key, _, _ in quotas], args=args)
+        return float(retry_after), (key.decode() if isinstance(key, bytes) else key) or None
+
+class RateLimiter:
+    def __init__(self, backend, user_limit: int, platform_limits: dict, global_limit: int, period: float = 60):
+        self.backend = backend
+        self.user_limit = user_limit
+        self.platform_limits = platform_limits
+        self.global_limit = global_limit
+        self.period = period
+
+    def _quota(self, key: str, limit: int) -> tuple:
+        interval = self.period / limit
+        return key, interval, self.period - interval
+
+    async def check(self, user: str, platform: str = None) -> tuple:
+        quotas = [self._quota(f"rl:user:{user}", self.user_limit)]
+        if platform in self.platform_limits:
+            quotas.append(self._quota(f"rl:platform:{platform}", self.platform_limits[platform]))
+        quotas.append(self._quota("rl:global", self.global_limit))
+        retry_after, key = await self.backend.acquire(quotas, time.time())
+        return retry_after, key == quotas[0][0]
+
+rate_limiter = RateLimiter(RedisRateBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryRateBackend(), MAX_REQUESTS_PER_MINUTE, PLATFORM_REQUESTS_PER_MINUTE, GLOBAL_REQUESTS_PER_MINUTE)
+
+class Extractor:
+    def __init__(self, name: str, platform: str, pattern: str, handler, backends=(), video=True, image=False, album=False, needs_auth=False, size_probe=False):
+        self.name = name
+        self.platform = platform
+        self.pattern = re.compile(pattern)
+        self.handler = handler
+        self.backends = backends
+        self.video = video
+        self.image = image
+        self.album = album
+        self.needs_auth = needs_auth
+        self.size_probe = size_probe
+
+    async def load(self):
+        for backend in self.backends:
+            if backend.module is None:
+                await asyncio.to_thread(backend.load)
+
+    async def extract(self, url: str, match: re.Match):
+        await self.load()
+        return await self.handler(match.group("arg") if "arg" in self.pattern.groupindex else url)
+
+class ExtractorRegistry:
+    def __init__(self):
+        self.hosts = {}
+        self.platforms = {}
+
+    def register(self, name: str, platform: str, hosts: tuple, pattern: str, **capabilities):
+        def decorator(handler):
+            extractor = Extractor(name, platform, pattern, handler, **capabilities)
+            for host in hosts:
+                self.hosts.setdefault(host, []).append(extractor)
+                self.platforms[host] = platform
+            return handler
+        return decorator
+
+    def _host(self, url: str) -> str:
+        host = (urlsplit(url.strip()).hostname or "").rstrip(".")
+        while host and host not in self.platforms:
+            host = host.partition(".")[2]
+        return host
+
+    def platform(self, url: str) -> str:
+        return self.platforms.get(self._host(url))
+
+    def match(self, url: str) -> tuple:
+        parts = urlsplit(url.strip())
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        for extractor in self.hosts.get(self._host(url), ()):
+            match = extractor.pattern.match(path)
+            if match:
+                return extractor, match
+        return None, None
+
+extractors = ExtractorRegistry()
+
+def platform_name(url: str) -> str:
+    return extractors.platform(url)
+
+TRACKING_PARAMS = {"si", "feature", "pp", "igsh", "igshid", "fbclid", "gclid", "mibextid", "rdid", "ref", "share_url", "is_from_webapp", "sender_device", "sender_web_id", "_r", "_t", "invite_link_id"}
+MEDIA_ID_PATTERNS = {
+    "YouTube": ("youtube", re.compile(r"/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)([\w-]{11})")),
+    "Instagram": ("instagram", re.compile(r"/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)")),
+    "TikTok": ("tiktok", re.compile(r"/@[\w.-]+/(?:video|photo)/(\d+)")),
+    "Facebook": ("facebook", re.compile(r"/(?:[\w.]+/videos/(?:[\w.-]+/)?|reel/|watch/?\?(?:[^#]*&)?v=)(\d+)")),
+    "Pinterest": ("pinterest", re.compile(r"/pin/(?:[\w-]*--)?(\d+)")),
+}
+
+def canonical_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host in ("youtu.be", "www.youtu.be"):
+        return f"https://www.youtube.com/watch?v={parts.path.strip('/')}"
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in TRACKING_PARAMS and not k.startswith("utm_")]
+    return urlunsplit((parts.scheme or "https", host, parts.path, urlencode(query), ""))
+
+async def resolve_url(url: str) -> str:
+    if url.startswith("https://pin.it/"):
+        url = await expand_short_url(url) or url
+    return canonical_url(url)
+
+def cache_key(url: str) -> str:
+    if "/stories/" in url or "/highlights/" in url:
+        return None
+    parts = urlsplit(url)
+    if platform_name(url) in MEDIA_ID_PATTERNS:
+        prefix, pattern = MEDIA_ID_PATTERNS[platform_name(url)]
+        match = pattern.match(parts.path + ("?" + parts.query if parts.query else ""))
+        if match:
+            return f"{prefix}:{match.group(1)}"
+    return urlunsplit(("https", parts.netloc.removeprefix("www.").removeprefix("m."), parts.path.rstrip("/"), parts.query, ""))
+
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class MediaCache:
+    def __init__(self, directory: str, max_bytes: int, ttl: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(directory, "index.db")
+        self.lock = threading.Lock()
+        self.readonly = False
+        os.makedirs(directory, exist_ok=True)
+        self.db = self.connect()
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, file TEXT, name TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0, file_id TEXT,
+            platform TEXT, is_video INTEGER, ctime REAL NOT NULL, atime REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self._import_json(os.path.join(directory, "index.json"))
+        for row in self.db.execute("SELECT key, file FROM entries WHERE file IS NOT NULL").fetchall():
+            if not os.path.exists(os.path.join(directory, row["file"])):
+                self.db.execute("UPDATE entries SET file = NULL, size = 0 WHERE key = ?", (row["key"],))
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _import_json(self, path: str):
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.db.executemany("INSERT OR IGNORE INTO entries (key, file, name, size, file_id, platform, is_video, ctime, atime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(key, e.get("file"), e.get("name", "vid.mp4"), e.get("size", 0), e.get("file_id"), e.get("platform"), e.get("is_video"), e["ctime"], e["atime"]) for key, e in entries.items()])
+        os.remove(path)
+
+    def _path(self, entry) -> str:
+        return os.path.join(self.directory, entry["file"])
+
+    def _drop_files(self, rows: list):
+        for row in rows:
+            try:
+                os.remove(self._path(row))
+            except OSError:
+                pass
+            self.size -= row["size"]
+
+    def _evict(self):
+        expired = self.db.execute("SELECT key, file, size FROM entries WHERE ctime < ?", (time.time() - self.ttl,)).fetchall()
+        self._drop_files([row for row in expired if row["file"]])
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [(row["key"],) for row in expired])
+        while self.size > self.max_bytes:
+            rows = self.db.execute("SELECT key, file, size FROM entries WHERE file IS NOT NULL ORDER BY atime LIMIT 64").fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if self.size <= self.max_bytes:
+                    break
+                self._drop_files([row])
+                self.db.execute("UPDATE entries SET file = NULL, size = 0 WHERE key = ?", (row["key"],))
+
+    def get(self, key: str) -> dict:
+        with self.lock:
+            row = self.db.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            if time.time() - row["ctime"] > self.ttl:
+                if not self.readonly:
+                    if row["file"]:
+                        self._drop_files([row])
+                    self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            if not self.readonly:
+                self.db.execute("UPDATE entries SET atime = ? WHERE key = ?", (time.time(), key))
+        return dict(row, is_video=bool(row["is_video"]))
+
+    def open(self, entry: dict) -> MediaFile:
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, entry["name"])
+        try:
+            link_or_copy(self._path(entry), path)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        return MediaFile(path, temp_dir)
+
+    def put(self, key: str, media: MediaFile, platform: str, is_video: bool):
+        size = media.size
+        if self.readonly or size > self.max_bytes:
+            return
+        file = hashlib.sha256(key.encode()).hexdigest() + os.path.splitext(media.name)[1]
+        link_or_copy(media.path, os.path.join(self.directory, f"{file}.tmp"))
+        os.replace(os.path.join(self.directory, f"{file}.tmp"), os.path.join(self.directory, file))
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT file, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old and old["file"] and old["file"] != file:
+                self._drop_files([old])
+            elif old and old["file"]:
+                self.size -= old["size"]
+            self.db.execute("""INSERT INTO entries (key, file, name, size, platform, is_video, ctime, atime) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET file = excluded.file, name = excluded.name, size = excluded.size,
+                platform = excluded.platform, is_video = excluded.is_video, atime = excluded.atime""",
+                (key, file, media.name, size, platform, is_video, now, now))
+            self.size += size
+            self._evict()
+
+    def set_file_id(self, key: str, file_id: str, platform: str, is_video: bool):
+        if self.readonly:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute("""INSERT INTO entries (key, name, file_id, platform, is_video, ctime, atime) VALUES (?, 'vid.mp4', ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id, platform = excluded.platform, is_video = excluded.is_video""",
+                (key, file_id, platform, is_video, now, now))
+
+media_cache = MediaCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL)
+
+class SingleFlight:
+    def __init__(self, share=None, release=None):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.share = share
+        self.release = release
+
+    async def do(self, key: str, fn):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = [Future(), 0]
+                else:
+                    call[1] += 1
+            if leader:
+                return await self._lead(key, call, fn)
+            future = call[0]
+            try:
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                if self.release:
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception() or self.release(f.result()))
+                raise
+
+    async def _lead(self, key: str, call: list, fn):
+        future = call[0]
+        try:
+            result = await fn()
+        except BaseException as e:
+            with self.lock:
+                self.calls.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+            raise
+        with self.lock:
+            self.calls.pop(key, None)
+            waiters = call[1]
+        if waiters and self.share:
+            self.share(result, waiters)
+        future.set_result(result)
+        return result
+
+def share_result(result: dict, count: int):
+    if result['success']:
+        result['data'].acquire(count)
+
+def release_result(result: dict):
+    if result['success']:
+        result['data'].close()
+
+downloads_in_flight = SingleFlight(share_result, release_result)
+
+class JobQueue:
+    def __init__(self, path: str, max_attempts: int, retry_delay: int, user_concurrency: int, retention: int):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.user_concurrency = user_concurrency
+        self.retention = retention
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = self.connect()
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, chat_id INTEGER, message_id INTEGER,
+            status_message_id INTEGER, url TEXT, state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL, created REAL NOT NULL, started REAL, error TEXT)""")
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        for column in ("kind TEXT NOT NULL DEFAULT 'telegram'", "token TEXT", "result TEXT"):
+            if column.split()[0] not in columns:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, state)")
+        self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+        self.messages = {}
+        self.wakeup = None
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def enqueue(self, user_id, chat_id: int, message_id: int, status_message_id: int, url: str, kind: str = 'telegram', token: str = None) -> int:
+        now = time.time()
+        with self.lock:
+            job_id = self.db.execute("INSERT INTO jobs (user_id, chat_id, message_id, status_message_id, url, run_at, created, kind, token) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (user_id, chat_id, message_id, status_message_id, url, now, now, kind, token)).lastrowid
+        if self.wakeup:
+            self.wakeup.set()
+        return job_id
+
+    def claim(self) -> dict:
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("""SELECT * FROM jobs j WHERE state = 'pending' AND run_at <= ?
+                    AND (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.state = 'running') < ?
+                    ORDER BY COALESCE((SELECT MAX(started) FROM jobs s WHERE s.user_id = j.user_id), 0), id LIMIT 1""",
+                    (now, self.user_concurrency)).fetchone()
+                if row:
+                    self.db.execute("UPDATE jobs SET state = 'running', started = ?, attempts = attempts + 1 WHERE id = ?", (now, row["id"]))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return dict(row, state='running', started=now, attempts=row["attempts"] + 1) if row else None
+
+    def get(self, job_id: int) -> dict:
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def finish(self, job_id: int, result: str = None, error: str = None):
+        expired = time.time() - self.retention
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = ?, result = ?, error = ? WHERE id = ?", ('failed' if error else 'done', result, error, job_id))
+            stale = self.db.execute("SELECT result FROM jobs WHERE state IN ('done', 'failed') AND created < ? AND result IS NOT NULL", (expired,)).fetchall()
+            self.db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND created < ?", (expired,))
+        for row in stale:
+            shutil.rmtree(os.path.dirname(row["result"]), ignore_errors=True)
+
+    def fail(self, job: dict, error: str) -> bool:
+        final = job["attempts"] >= self.max_attempts
+        with self.lock:
+            if final:
+                self.db.execute("UPDATE jobs SET state = 'failed', error = ? WHERE id = ?", (error, job["id"]))
+            else:
+                self.db.execute("UPDATE jobs SET state = 'pending', error = ?, run_at = ? WHERE id = ?",
+                                (error, time.time() + self.retry_delay * 2 ** (job["attempts"] - 1), job["id"]))
+        return final
+
+    async def run(self, handler, workers: int):
+        self.wakeup = asyncio.Event()
+        await asyncio.gather(*(self._worker(handler) for _ in range(workers)))
+
+    async def _worker(self, handler):
+        while True:
+            job = self.claim()
+            if not job:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                outcome = await handler(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Job {job['id']} failed (attempt {job['attempts']}): {e}")
+                self.fail(job, str(e))
+            else:
+                self.finish(job["id"], **(outcome or {}))
+
+job_queue = JobQueue(JOBS_DB, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_USER_CONCURRENCY, JOB_RETENTION)
+
+class JobFailed(Exception):
+    pass
+
+class ProgressReporter:
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.loop = asyncio.get_running_loop()
+        self.last = 0
+        self.delivered = False
+
+    def report(self, stage: str, done: int, total: int):
+        now = time.monotonic()
+        if not total or now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        asyncio.run_coroutine_threadsafe(self.edit(f"{stage} {min(done * 100 // total, 100)}%"), self.loop)
+
+    async def upload(self, current: int, total: int):
+        self.report("⬆️ جاري الرفع...", current, total)
+
+    async def edit(self, text: str):
+        try:
+            await bot.edit_message_text(self.chat_id, self.message_id, text)
+        except Exception:
+            pass
 
-def check_pair_site_availability():
+progress_reporter = contextvars.ContextVar("progress_reporter", default=None)
+
+def sent_file_id(sent: Message) -> str:
+    media = (sent.video or sent.photo or sent.document or sent.animation) if sent else None
+    return media.file_id if media else None
+
+@routes.get('/check')
+async def check_server_status(request: web.Request):
+    return web.json_response({
+        "status": "available",
+        "message": "Server is running",
+        "uptime": round(time.perf_counter() - BOOT_STARTED, 3),
+        "startup": startup_timings,
+        "backends": {name: backend.module is not None for name, backend in BACKENDS.items()},
+    })
+
+@routes.get('/metrics')
+async def metrics_endpoint(request: web.Request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+async def check_pair_site_availability():
     if PAIR_SITE:
         try:
-            response = requests.get(PAIR_SITE, timeout=10)
-            logging.info(f"PAIR_SITE ({PAIR_SITE}) status: {response.status_code}")
-        except requests.exceptions.RequestException as e:
+            async with http.request("GET", PAIR_SITE, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                logging.info(f"PAIR_SITE ({PAIR_SITE}) status: {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logging.error(f"Error checking PAIR_SITE: {e}")
 
 HTML_TEMPLATE = """
@@ -167,25 +1153,75 @@ HTML_TEMPLATE = """
 </html>
 """
 
-def check_data_size(data: bytes) -> bool:
-    return len(data) <= MAX_FILE_SIZE
+def check_data_size(size: int) -> bool:
+    return size <= MAX_FILE_SIZE
 
 def get_platform_hashtag(platform: str) -> str:
     hashtags = {"Instagram": "#instagram", "Instagram Stories": "#instagram", "Instagram Highlights": "#instagram", "YouTube": "#youtube", "TikTok": "#tiktok", "Facebook": "#facebook", "Pinterest Video": "#pinterest", "Pinterest Image": "#pinterest"}
     return hashtags.get(platform, "#unknown")
 
-async def send_to_channel(media_data: BytesIO, original_url: str, platform: str, is_video: bool = True):
-    if not CHANNEL_ID:
-        return
-    try:
-        caption = f"{original_url}\n{get_platform_hashtag(platform)}"
-        media_data.seek(0)
-        if is_video:
-            await bot.send_video(chat_id=int(CHANNEL_ID), video=media_data, caption=caption, file_name="vid.mp4")
-        else:
-            await bot.send_photo(chat_id=int(CHANNEL_ID), photo=media_data, caption=caption)
-    except Exception as e:
-        logging.error(f"Error sending to channel: {e}")
+class ChannelMirror:
+    def __init__(self, channels: list, backlog: int, batch_window: float):
+        self.channels = channels
+        self.batch_window = batch_window
+        self.queue = asyncio.Queue(maxsize=backlog)
+        self.recent = OrderedDict()
+
+    def post(self, file_id: str, is_video: bool, original_url: str, platform: str, key: str = None):
+        if not self.channels or not file_id:
+            return
+        dedupe_key = key or file_id
+        if dedupe_key in self.recent:
+            return
+        try:
+            self.queue.put_nowait((file_id, is_video, f"{original_url}\n{get_platform_hashtag(platform)}", platform))
+        except asyncio.QueueFull:
+            metrics.inc("channel_posts_dropped_total")
+            logging.warning(f"Channel backlog full, dropping {original_url}")
+            return
+        metrics.add("channel_backlog", 1)
+        self.recent[dedupe_key] = True
+        while len(self.recent) > 1000:
+            self.recent.popitem(last=False)
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < MEDIA_GROUP_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=max(deadline - time.monotonic(), 0)))
+            except asyncio.TimeoutError:
+                break
+        metrics.add("channel_backlog", -len(batch))
+        return batch
+
+    async def _send(self, channel: int, batch: list):
+        while True:
+            try:
+                platforms = {platform for _, _, _, platform in batch}
+                with stage("channel_repost", platforms.pop() if len(platforms) == 1 else "mixed"):
+                    if len(batch) == 1:
+                        file_id, _, caption, _ = batch[0]
+                        await bot.send_cached_media(chat_id=channel, file_id=file_id, caption=caption)
+                    else:
+                        await bot.send_media_group(chat_id=channel, media=[InputMediaVideo(file_id, caption=caption) if is_video else InputMediaPhoto(file_id, caption=caption) for file_id, is_video, caption, _ in batch])
+                metrics.inc("channel_posts_total", len(batch))
+                return
+            except FloodWait as e:
+                metrics.inc("channel_flood_waits_total")
+                logging.warning(f"Flood wait of {e.value}s while mirroring to {channel}")
+                await asyncio.sleep(e.value)
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            for channel in self.channels:
+                try:
+                    await self._send(channel, batch)
+                except Exception as e:
+                    logging.error(f"Error sending to channel: {e}")
+
+channel_mirror = ChannelMirror(CHANNEL_IDS, CHANNEL_BACKLOG, CHANNEL_BATCH_WINDOW)
 
 @bot.on_message(filters.command("start"))
 async def start(client: Client, message: Message):
@@ -195,182 +1231,642 @@ async def start(client: Client, message: Message):
         "⚠️ الحد الأقصى لحجم الملف للتحميل: 50 ميجابايت."
     )
 
+URL_PATTERN = re.compile(r"https?://[^\s<>\"']+")
+
+def extract_urls(message: Message) -> list:
+    text = message.text or ""
+    encoded = text.encode("utf-16-le")
+    urls = []
+    for entity in message.entities or []:
+        if entity.type == MessageEntityType.TEXT_LINK:
+            urls.append(entity.url)
+        elif entity.type == MessageEntityType.URL:
+            url = encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode("utf-16-le")
+            urls.append(url if "://" in url else f"https://{url}")
+    urls += [url.rstrip(".,;:!?)]}") for url in URL_PATTERN.findall(text)]
+    return list(dict.fromkeys(urls))
+
 @bot.on_message(filters.text & filters.private & ~filters.regex(r"^/"))
 async def handle_message(client: Client, message: Message):
     user_id = message.from_user.id
-    url = message.text
-    now = datetime.now()
-    
-    if user_id in user_requests:
-        user_requests[user_id] = [req for req in user_requests[user_id] if now - req < timedelta(minutes=1)]
-        if len(user_requests[user_id]) >= MAX_REQUESTS_PER_MINUTE:
-            await message.reply_text("لقد تجاوزت حد 5 تحميلات في الدقيقة. يرجى الانتظار.")
-            return
-        user_requests[user_id].append(now)
+    urls = extract_urls(message)[:BATCH_MAX_URLS]
+    if not urls:
+        await message.reply_text("منصة غير مدعومة.")
+        return
+
+    accepted = []
+    for url in urls:
+        retry_after, user_limited = await rate_limiter.check(f"tg:{user_id}", platform_name(url))
+        if retry_after:
+            break
+        accepted.append(url)
+    if not accepted:
+        await message.reply_text("لقد تجاوزت حد 5 تحميلات في الدقيقة. يرجى الانتظار." if user_limited else "الخادم مشغول حاليًا، يرجى المحاولة بعد قليل.")
+        return
+
+    text = "⏳ تم استلام طلبك، جاري المعالجة..."
+    if len(accepted) < len(urls):
+        text += f"\n⚠️ تم تجاوز حد التحميل، سيتم معالجة {len(accepted)} من {len(urls)} روابط فقط."
+    status = await message.reply_text(text)
+    job_id = job_queue.enqueue(user_id, message.chat.id, message.id, status.id, "\n".join(accepted))
+    job_queue.messages[job_id] = message
+
+async def process_job(job: dict):
+    if job['kind'] == 'web':
+        return await process_web_job(job)
+    message = job_queue.messages.get(job['id']) or await bot.get_messages(job['chat_id'], job['message_id'])
+    reporter = ProgressReporter(job['chat_id'], job['status_message_id'])
+    progress_reporter.set(reporter)
+    transcode_priority.set(0)
+    try:
+        with traced("job", job_id=job['id'], url=job['url']), metrics.in_flight("jobs_running"):
+            urls = job['url'].split("\n")
+            if len(urls) > 1:
+                await deliver_batch(message, urls, reporter)
+            else:
+                await deliver(message, job['url'], reporter)
+    except Exception as e:
+        if job['attempts'] < JOB_MAX_ATTEMPTS and not reporter.delivered:
+            await reporter.edit("🔄 حدث خطأ، سيتم إعادة المحاولة...")
+            raise
+        logging.error(f"Job {job['id']} failed: {e}")
+        outcome = {'error': str(e)}
+        try:
+            await message.reply_text(str(e) if isinstance(e, JobFailed) else "حدث خطأ أثناء معالجة طلبك.")
+        except Exception:
+            pass
     else:
-        user_requests[user_id] = [now]
+        outcome = None
+    job_queue.messages.pop(job['id'], None)
+    try:
+        await bot.delete_messages(job['chat_id'], job['status_message_id'])
+    except Exception:
+        pass
+    return outcome
 
+async def process_web_job(job: dict) -> dict:
+    progress_reporter.set(None)
+    transcode_priority.set(1)
+    with traced("web_job", job_id=job['id'], url=job['url']), metrics.in_flight("jobs_running"):
+        result = await get_web_media(await resolve_url(job['url']))
+    if not result['success']:
+        if result.get('retry'):
+            raise JobFailed(result['error'])
+        return {'error': result['error']}
+    media = result['data']
     try:
-        result = await process_download(url)
-        if result['success']:
-            media_data = result['data']
-            media_bytes = media_data.getvalue()
-            if check_data_size(media_bytes):
-                media_data.seek(0)
-                if result['is_video']:
-                    await message.reply_video(video=media_data)
-                else:
-                    await message.reply_photo(photo=media_data)
-                if result['platform']:
-                    channel_media = named_bytesio(media_bytes)
-                    await send_to_channel(channel_media, url, result['platform'], result['is_video'])
-                    channel_media.close()
+        if not check_data_size(media.size):
+            metrics.inc("oversized_rejections_total", platform=platform_name(job['url']) or "unknown")
+            return {'error': 'حجم الملف يتجاوز حد 50 ميجابايت'}
+        path = os.path.join(BATCH_DIR, str(job['id']), media.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(media.path, path)
+        return {'result': path}
+    finally:
+        media.close()
+
+async def deliver(message: Message, url: str, reporter: ProgressReporter):
+    platform = platform_name(url) or "unknown"
+    with stage("resolve", platform):
+        url = await resolve_url(url)
+    key = cache_key(url)
+    cached = media_cache.get(key) if key else None
+    if cached and cached.get('file_id'):
+        metrics.inc("cache_hits_total", kind="file_id")
+        with stage("telegram_resend", platform):
+            await message.reply_cached_media(cached['file_id'])
+        reporter.delivered = True
+        return
+    result = await get_media(url)
+    if result['success'] and 'album' in result:
+        await send_album(message, result['album'], url, result['platform'], reporter)
+    elif result['success']:
+        media = result['data']
+        try:
+            if check_data_size(media.size):
+                with stage("telegram_upload", platform):
+                    if result['is_video']:
+                        sent = await message.reply_video(video=media.path, thumb=media.thumb, supports_streaming=True, progress=reporter.upload)
+                    else:
+                        sent = await message.reply_photo(photo=media.path, progress=reporter.upload)
+                reporter.delivered = True
+                metrics.inc("bytes_uploaded_total", media.size, target="user")
+                if key and sent_file_id(sent):
+                    media_cache.set_file_id(key, sent_file_id(sent), result['platform'], result['is_video'])
+                if result['platform'] and not result.get('cached'):
+                    channel_mirror.post(sent_file_id(sent), result['is_video'], url, result['platform'], key)
             else:
+                metrics.inc("oversized_rejections_total", platform=platform)
                 await message.reply_text("حجم الملف يتجاوز حد 50 ميجابايت.")
-            media_data.close()
-        else:
-            await message.reply_text(result['error'])
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        await message.reply_text("حدث خطأ أثناء معالجة طلبك.")
+        finally:
+            media.close()
+    elif result.get('retry'):
+        raise JobFailed(result['error'])
+    else:
+        await message.reply_text(result['error'])
 
-async def process_download(url: str) -> dict:
+async def deliver_batch(message: Message, urls: list, reporter: ProgressReporter):
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def fetch(url: str) -> tuple:
+        progress_reporter.set(None)
+        transcode_priority.set(1)
+        async with semaphore:
+            try:
+                url = await resolve_url(url)
+                key = cache_key(url)
+                cached = media_cache.get(key) if key else None
+                if cached and cached.get('file_id'):
+                    metrics.inc("cache_hits_total", kind="file_id")
+                    return url, key, {'success': True, 'file_id': cached['file_id'], 'platform': cached['platform'], 'is_video': cached['is_video']}
+                return url, key, await get_media(url)
+            except Exception as e:
+                return url, None, {'success': False, 'error': f'حدث خطأ: {str(e)}'}
+
+    pending = {asyncio.ensure_future(fetch(url)) for url in urls}
+    errors, finished = [], 0
     try:
-        if url.startswith("https://pin.it/"):
-            url = expand_short_url(url) or url
-
-        if "instagram.com" in url:
-            if "/stories/" in url:
-                media_data = await download_instagram_stories(url.split("/stories/")[1].split("/")[0])
-                platform = "Instagram Stories"
-            elif "/reel/" in url or "/p/" in url:
-                media_data = await download_instagram_media(url)
-                platform = "Instagram"
-            elif "/highlights/" in url:
-                media_data = await download_instagram_highlights(url.split("/highlights/")[1].split("/")[0])
-                platform = "Instagram Highlights"
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            group, albums = [], []
+            for task in done:
+                url, key, result = task.result()
+                if not result['success']:
+                    errors.append(f"{url}\n{result['error']}")
+                elif 'album' in result:
+                    albums.append((url, result))
+                elif 'file_id' in result or check_data_size(result['data'].size):
+                    group.append((url, key, result))
+                else:
+                    metrics.inc("oversized_rejections_total", platform=platform_name(url) or "unknown")
+                    errors.append(f"{url}\nحجم الملف يتجاوز حد 50 ميجابايت.")
+                    result['data'].close()
+            for i in range(0, len(group), MEDIA_GROUP_SIZE):
+                await send_batch_group(message, group[i:i + MEDIA_GROUP_SIZE])
+                reporter.delivered = True
+            for url, result in albums:
+                await send_album(message, result['album'], url, result['platform'], reporter)
+            finished += len(done)
+            await reporter.edit(f"⏳ {finished}/{len(urls)}")
+    finally:
+        for task in pending:
+            task.cancel()
+    if errors:
+        await message.reply_text("⚠️ تعذر تحميل بعض الروابط:\n\n" + "\n\n".join(errors))
+
+async def send_batch_group(message: Message, group: list):
+    try:
+        sources = [result.get('file_id') or result['data'].path for _, _, result in group]
+        platforms = {platform_name(url) or "unknown" for url, _, _ in group}
+        with stage("telegram_upload", platforms.pop() if len(platforms) == 1 else "mixed"):
+            if len(group) > 1:
+                sent = await message.reply_media_group([InputMediaVideo(source) if result['is_video'] else InputMediaPhoto(source) for source, (_, _, result) in zip(sources, group)])
+            elif 'file_id' in group[0][2]:
+                sent = [await message.reply_cached_media(sources[0])]
+            elif group[0][2]['is_video']:
+                sent = [await message.reply_video(video=sources[0])]
             else:
-                return {'success': False, 'error': 'رابط Instagram غير مدعوم.'}
-            is_video = True
-        elif "youtube.com" in url or "youtu.be" in url:
-            media_data = await download_youtube_video(url)
-            platform, is_video = "YouTube", True
-        elif "tiktok.com" in url:
-            media_data = await download_tiktok_video(url)
-            platform, is_video = "TikTok", True
-        elif "facebook.com" in url:
-            media_data = await download_facebook_video(url)
-            platform, is_video = "Facebook", True
-        elif "pinterest.com" in url:
-            download_url = await get_download_url(url)
-            if download_url:
-                is_video = '.mp4' in download_url
-                media_data = await download_video(download_url) if is_video else await download_image(download_url)
-                platform = "Pinterest Video" if is_video else "Pinterest Image"
+                sent = [await message.reply_photo(photo=sources[0])]
+        for (url, key, result), item in zip(group, sent):
+            if 'data' not in result:
+                continue
+            metrics.inc("bytes_uploaded_total", result['data'].size, target="user")
+            if key and sent_file_id(item):
+                media_cache.set_file_id(key, sent_file_id(item), result['platform'], result['is_video'])
+            if not result.get('cached'):
+                channel_mirror.post(sent_file_id(item), result['is_video'], url, result['platform'], key)
+    finally:
+        for _, _, result in group:
+            if 'data' in result:
+                result['data'].close()
+
+async def send_album(message: Message, album: AsyncIterator, url: str, platform: str, reporter: ProgressReporter):
+    group = []
+    try:
+        async for item in album:
+            group.append(item)
+            if len(group) == MEDIA_GROUP_SIZE:
+                await send_media_group(message, group, url, platform)
+                reporter.delivered = True
+                group = []
+        if group:
+            await send_media_group(message, group, url, platform)
+            reporter.delivered = True
+            group = []
+    finally:
+        for media, _ in group:
+            media.close()
+        await album.aclose()
+
+async def send_media_group(message: Message, group: list, url: str, platform: str):
+    try:
+        if len(group) == 1:
+            media, is_video = group[0]
+            if is_video:
+                sent = [await message.reply_video(video=media.path)]
             else:
-                return {'success': False, 'error': 'فشل في الحصول على رابط التحميل من Pinterest.'}
+                sent = [await message.reply_photo(photo=media.path)]
         else:
+            sent = await message.reply_media_group([InputMediaVideo(media.path) if is_video else InputMediaPhoto(media.path) for media, is_video in group])
+        for item in sent:
+            channel_mirror.post(sent_file_id(item), bool(item.video), url, platform)
+    finally:
+        for media, _ in group:
+            media.close()
+
+async def get_media(url: str) -> dict:
+    url = await resolve_url(url)
+    key = cache_key(url)
+    cached = media_cache.get(key) if key else None
+    if cached and cached.get('file'):
+        try:
+            with stage("cache_read", platform_name(url) or "unknown"):
+                media = await asyncio.to_thread(media_cache.open, cached)
+        except FileNotFoundError:
+            media = None
+        if media:
+            metrics.inc("cache_hits_total", kind="disk")
+            return {'success': True, 'data': media, 'platform': cached['platform'], 'is_video': cached['is_video'], 'cached': True}
+    if key:
+        metrics.inc("cache_misses_total")
+    if not key:
+        return await process_download(url)
+    return await downloads_in_flight.do(key, lambda: download_and_cache(url, key))
+
+async def download_and_cache(url: str, key: str) -> dict:
+    result = await process_download(url)
+    if result['success'] and check_data_size(result['data'].size):
+        try:
+            await asyncio.to_thread(media_cache.put, key, result['data'], result['platform'], result['is_video'])
+        except OSError as e:
+            logging.error(f"Error caching {key}: {e}")
+    return result
+
+async def process_download(url: str) -> dict:
+    platform = platform_name(url) or "unknown"
+    with stage("dispatch", platform), metrics.in_flight("downloads_in_flight", platform=platform):
+        result = await dispatch_download(url)
+    if result['success'] and 'data' in result:
+        metrics.inc("bytes_downloaded_total", result['data'].size, platform=platform)
+    elif not result['success']:
+        metrics.inc("download_errors_total", platform=platform, kind=result.get('kind', 'error'))
+        if result.get('kind') == 'oversized':
+            metrics.inc("oversized_rejections_total", platform=platform)
+    return result
+
+async def dispatch_download(url: str) -> dict:
+    try:
+        if url.startswith("https://pin.it/"):
+            url = await expand_short_url(url) or url
+
+        extractor, match = extractors.match(url)
+        if not extractor:
             return {'success': False, 'error': 'منصة غير مدعومة.'}
+        media_data = await extractor.extract(url, match)
+        platform, is_video = extractor.name, extractor.video
+        if isinstance(media_data, tuple):
+            media_data, platform, is_video = media_data
 
-        if isinstance(media_data, BytesIO):
-            return {'success': True, 'data': media_data, 'platform': platform, 'is_video': is_video}
+        if isinstance(media_data, MediaFile):
+            return {'success': True, 'data': media_data, 'platform': platform, 'is_video': is_video, 'info': media_data.info}
+        if isinstance(media_data, AsyncIterator):
+            return {'success': True, 'album': media_data, 'platform': platform, 'is_video': is_video}
         return {'success': False, 'error': media_data if isinstance(media_data, str) else 'حدث خطأ أثناء التحميل.'}
+    except EngineBusy as e:
+        return {'success': False, 'error': str(e), 'retry': True, 'kind': 'busy'}
+    except MediaTooLarge as e:
+        return {'success': False, 'error': str(e), 'kind': 'oversized'}
     except Exception as e:
-        return {'success': False, 'error': f'حدث خطأ: {str(e)}'}
+        return {'success': False, 'error': f'حدث خطأ: {str(e)}', 'retry': True}
 
-async def download_with_ytdlp(url: str) -> BytesIO:
-    temp_dir = tempfile.mkdtemp()
-    try:
-        ydl_opts = {'format': 'best', 'outtmpl': f"{temp_dir}/vid.mp4", 'quiet': True, 'cookiefile': COOKIES_FILE if os.path.exists(COOKIES_FILE) else None}
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        with open(f"{temp_dir}/vid.mp4", 'rb') as f:
-            return named_bytesio(f.read())
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        # subprocess.run("command", shell=True, capture_output=True, text=True, timeout=30)
-     
-        # subprocess.run(['yt-dlp', '--rm-cache-dir'], capture_output=True)
+probe_cache = OrderedDict()
+stream_target = contextvars.ContextVar("stream_target", default=None)
 
-async def download_instagram_media(url: str) -> BytesIO:
-    return await download_with_ytdlp(url)
+def announce_stream(path: str):
+    target = stream_target.get()
+    if target and not target.done():
+        target.set_result(path)
 
-async def download_youtube_video(url: str) -> BytesIO:
-    return await download_with_ytdlp(url)
+def ytdlp_options(**extra) -> dict:
+    return {'quiet': True, 'noplaylist': True, 'cookiefile': YTDLP_COOKIES, **extra}
 
-async def download_tiktok_video(url: str) -> BytesIO:
-    return await download_with_ytdlp(url)
+def select_format(info: dict, limit: int) -> str:
+    formats = info.get('formats')
+    if not formats:
+        size = info.get('filesize') or info.get('filesize_approx')
+        if size and size > limit:
+            raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+        return None
+    combined = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none'] or formats
+    unknown = None
+    for f in reversed(combined):
+        size = f.get('filesize') or f.get('filesize_approx')
+        if size is None:
+            unknown = unknown or f['format_id']
+        elif size <= limit:
+            return f['format_id']
+    if unknown:
+        return unknown
+    raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
 
-async def download_facebook_video(url: str) -> BytesIO:
-    return await download_with_ytdlp(url)
+def _ytdlp_probe(url: str) -> dict:
+    with yt_dlp.YoutubeDL(ytdlp_options()) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
 
-async def download_instagram_stories(username: str) -> BytesIO:
-    temp_dir = tempfile.mkdtemp()
+async def probe_media(url: str, platform: str) -> dict:
+    cached = probe_cache.get(url)
+    if cached and time.time() - cached[0] < PROBE_TTL:
+        return cached[1]
+    with stage("ytdlp_probe", platform):
+        info = await engine.run(platform, _ytdlp_probe, url)
+    probe_cache[url] = (time.time(), info)
+    while len(probe_cache) > 256:
+        probe_cache.popitem(last=False)
+    return info
+
+def _ytdlp_download(info: dict, format_id: str, temp_dir: str, reporter: ProgressReporter = None, limit: int = MAX_FILE_SIZE) -> MediaFile:
+    exceeded = []
+    def cap_size(progress: dict):
+        if (progress.get('downloaded_bytes') or 0) > limit:
+            exceeded.append(True)
+            raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+        if reporter:
+            reporter.report("⬇️ جاري التحميل...", progress.get('downloaded_bytes') or 0, progress.get('total_bytes') or progress.get('total_bytes_estimate'))
     try:
-        L = instaloader.Instaloader()
-        if os.path.exists("auth.json"):
-            with open("auth.json", "r") as f:
-                auth = json.load(f)
-            L.login(auth["username"], auth["password"])
-        profile = instaloader.Profile.from_username(L.context, username)
-        for story in L.get_stories([profile.userid]):
-            for item in story.get_items():
-                L.download_storyitem(item, target=temp_dir)
-                for file in os.listdir(temp_dir):
-                    if file.endswith(('.mp4', '.jpg', '.png')):
-                        with open(os.path.join(temp_dir, file), 'rb') as f:
-                            return named_bytesio(f.read(), file)
-        return "لم يتم العثور على stories."
-    finally:
+        ydl_opts = ytdlp_options(format=format_id or 'best', outtmpl=f"{temp_dir}/vid.mp4", nopart=True, progress_hooks=[cap_size])
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.process_ie_result(dict(info), download=True)
+        media = MediaFile(f"{temp_dir}/vid.mp4", temp_dir)
+        media.info = info
+        return media
+    except BaseException as e:
         shutil.rmtree(temp_dir, ignore_errors=True)
+        if exceeded and not isinstance(e, MediaTooLarge):
+            raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.") from e
+        raise
 
-async def download_instagram_highlights(username: str) -> BytesIO:
+async def download_with_ytdlp(url: str, platform: str) -> MediaFile:
+    info = await probe_media(url, platform)
+    try:
+        format_id = select_format(info, MAX_FILE_SIZE)
+    except MediaTooLarge:
+        if not TRANSCODE:
+            raise
+        format_id = select_format(info, TRANSCODE_SOURCE_LIMIT)
     temp_dir = tempfile.mkdtemp()
+    chosen = next((f for f in info.get('formats') or [info] if f.get('format_id') == format_id), info)
+    if chosen.get('protocol') in ('http', 'https') and not TRANSCODE:
+        announce_stream(f"{temp_dir}/vid.mp4")
     try:
-        L = instaloader.Instaloader()
-        if os.path.exists("auth.json"):
-            with open("auth.json", "r") as f:
-                auth = json.load(f)
-            L.login(auth["username"], auth["password"])
-        profile = instaloader.Profile.from_username(L.context, username)
-        for highlight in L.get_highlights(profile):
-            for item in highlight.get_items():
-                L.download_storyitem(item, target=temp_dir)
-                for file in os.listdir(temp_dir):
-                    if file.endswith(('.mp4', '.jpg', '.png')):
-                        with open(os.path.join(temp_dir, file), 'rb') as f:
-                            return named_bytesio(f.read(), file)
-        return "لم يتم العثور على highlights."
-    finally:
+        with stage("ytdlp_download", platform):
+            media = await engine.run(platform, _ytdlp_download, info, format_id, temp_dir, progress_reporter.get(), DOWNLOAD_LIMIT)
+    except BaseException:
         shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    if not TRANSCODE:
+        return media
+    try:
+        return await postprocess(media, platform)
+    except BaseException:
+        media.close()
+        raise
+
+async def postprocess(media: MediaFile, platform: str) -> MediaFile:
+    duration = (media.info or {}).get('duration')
+    if not duration:
+        return media
+    priority = transcode_priority.get()
+    output = os.path.join(media.temp_dir, "out.mp4")
+    if media.size > MAX_FILE_SIZE:
+        audio = 96_000
+        video = int(MAX_FILE_SIZE * 8 * 0.92 / duration) - audio
+        if video < 150_000:
+            raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+        with stage("transcode", platform):
+            ok = await transcoder.run(["-i", media.path], [
+                "-vf", "scale=-2:'min(720,ih)'", "-c:v", "libx264", "-preset", "veryfast", "-b:v", str(video), "-maxrate", str(video), "-bufsize", str(video * 2),
+                "-c:a", "aac", "-b:a", str(audio), "-movflags", "+faststart"], output, priority)
+        if not ok or os.path.getsize(output) > MAX_FILE_SIZE:
+            raise MediaTooLarge("حجم الملف يتجاوز حد 50 ميجابايت.")
+        metrics.inc("transcodes_total", platform=platform)
+    else:
+        with stage("remux", platform):
+            ok = await transcoder.run(["-i", media.path], ["-c", "copy", "-movflags", "+faststart"], output, priority)
+    if ok:
+        os.replace(output, media.path)
+    thumb = os.path.join(media.temp_dir, "thumb.jpg")
+    with stage("thumbnail", platform):
+        if await transcoder.run(["-ss", str(min(1, duration / 2)), "-i", media.path], ["-frames:v", "1", "-vf", "scale=320:-2"], thumb, priority):
+            media.thumb = thumb
+    return media
+
+@extractors.register("Instagram", "Instagram", ("instagram.com", "instagr.am"), r"/(?:[\w.]+/)?(?:p|reels?|tv)/[\w-]+", backends=(yt_dlp,), image=True, needs_auth=True, size_probe=True)
+async def download_instagram_media(url: str) -> MediaFile:
+    return await download_with_ytdlp(url, "Instagram")
+
+@extractors.register("YouTube", "YouTube", ("youtube.com", "youtu.be"), r"/(?:watch\?|shorts/|embed/|live/|[\w-]{11}/?(?:\?|$))", backends=(yt_dlp,), size_probe=True)
+async def download_youtube_video(url: str) -> MediaFile:
+    return await download_with_ytdlp(url, "YouTube")
+
+@extractors.register("TikTok", "TikTok", ("tiktok.com",), r"/", backends=(yt_dlp,), size_probe=True)
+async def download_tiktok_video(url: str) -> MediaFile:
+    return await download_with_ytdlp(url, "TikTok")
+
+@extractors.register("Facebook", "Facebook", ("facebook.com", "fb.watch"), r"/", backends=(yt_dlp,), size_probe=True)
+async def download_facebook_video(url: str) -> MediaFile:
+    return await download_with_ytdlp(url, "Facebook")
+
+class InstaloaderPool:
+    def __init__(self, auth_file: str, session_dir: str, cooldown: int, profile_ttl: int):
+        self.auth_file = auth_file
+        self.session_dir = session_dir
+        self.cooldown = cooldown
+        self.profile_ttl = profile_ttl
+        self.condition = threading.Condition()
+        self.accounts = None
+        self.loaders = {}
+        self.busy = set()
+        self.cooling = {}
+        self.profiles = OrderedDict()
+
+    def _load_accounts(self) -> deque:
+        if not os.path.exists(self.auth_file):
+            return deque()
+        with open(self.auth_file, "r") as f:
+            auth = json.load(f)
+        return deque(auth if isinstance(auth, list) else [auth])
+
+    def _checkout(self) -> dict:
+        with self.condition:
+            if self.accounts is None:
+                self.accounts = self._load_accounts()
+            if not self.accounts:
+                return None
+            while True:
+                now = time.time()
+                if all(self.cooling.get(a["username"], 0) > now for a in self.accounts):
+                    raise EngineBusy("حسابات Instagram مقيدة مؤقتًا، يرجى المحاولة لاحقًا.")
+                for _ in range(len(self.accounts)):
+                    account = self.accounts[0]
+                    self.accounts.rotate(-1)
+                    if account["username"] not in self.busy and self.cooling.get(account["username"], 0) <= now:
+                        self.busy.add(account["username"])
+                        return account
+                self.condition.wait(timeout=5)
 
-def expand_short_url(short_url: str) -> str:
+    def _checkin(self, account: dict, throttled: bool = False):
+        with self.condition:
+            self.busy.discard(account["username"])
+            if throttled:
+                self.cooling[account["username"]] = time.time() + self.cooldown
+            self.condition.notify()
+
+    def _loader(self, account: dict):
+        L = self.loaders.get(account["username"])
+        if L:
+            return L
+        L = instaloader.Instaloader(quiet=True)
+        os.makedirs(self.session_dir, exist_ok=True)
+        session_file = os.path.join(self.session_dir, f"session-{account['username']}")
+        try:
+            L.load_session_from_file(account["username"], session_file)
+        except FileNotFoundError:
+            L.login(account["username"], account["password"])
+            L.save_session_to_file(session_file)
+        self.loaders[account["username"]] = L
+        return L
+
+    @contextmanager
+    def session(self):
+        account = self._checkout()
+        if account is None:
+            yield instaloader.Instaloader(quiet=True)
+            return
+        errors = instaloader.exceptions
+        throttled = False
+        try:
+            yield self._loader(account)
+        except (errors.TooManyRequestsException, errors.QueryReturnedBadRequestException, errors.LoginRequiredException, errors.LoginException, errors.BadCredentialsException, errors.TwoFactorAuthRequiredException) as e:
+            logging.warning(f"Instagram account {account['username']} throttled, cooling down: {e}")
+            throttled = True
+            if not isinstance(e, (errors.TooManyRequestsException, errors.QueryReturnedBadRequestException)):
+                self.loaders.pop(account["username"], None)
+                try:
+                    os.remove(os.path.join(self.session_dir, f"session-{account['username']}"))
+                except OSError:
+                    pass
+            raise
+        finally:
+            self._checkin(account, throttled)
+
+    def userid(self, L, username: str) -> int:
+        with self.condition:
+            cached = self.profiles.get(username)
+            if cached and time.time() - cached[0] < self.profile_ttl:
+                self.profiles.move_to_end(username)
+                return cached[1]
+        userid = instaloader.Profile.from_username(L.context, username).userid
+        with self.condition:
+            self.profiles[username] = (time.time(), userid)
+            self.profiles.move_to_end(username)
+            while len(self.profiles) > 1024:
+                self.profiles.popitem(last=False)
+        return userid
+
+instagram_sessions = InstaloaderPool("auth.json", INSTAGRAM_SESSION_DIR, INSTAGRAM_COOLDOWN, PROFILE_CACHE_TTL)
+
+def _instagram_story_items(username: str, highlights: bool) -> list:
+    with instagram_sessions.session() as L:
+        userid = instagram_sessions.userid(L, username)
+        reels = L.get_highlights(userid) if highlights else L.get_stories([userid])
+        return [(item.video_url if item.is_video else item.url, item.is_video) for reel in reels for item in reel.get_items()]
+
+async def download_album(items: list, platform: str) -> AsyncIterator:
+    semaphore = asyncio.Semaphore(ALBUM_CONCURRENCY)
+    async def fetch(url: str, is_video: bool):
+        stream_target.set(None)
+        progress_reporter.set(None)
+        async with semaphore:
+            return await download_video(url, platform), is_video
+    pending = {asyncio.ensure_future(fetch(url, is_video)) for url, is_video in items}
     try:
-        return requests.get(short_url, allow_redirects=True).url
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.discard(task)
+                if task.exception():
+                    logging.error(f"Error downloading album item: {task.exception()}")
+                elif not isinstance(task.result()[0], MediaFile):
+                    logging.error(f"Error downloading album item: {task.result()[0]}")
+                else:
+                    yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, tuple) and isinstance(result[0], MediaFile):
+                result[0].close()
+
+@extractors.register("Instagram Stories", "Instagram", ("instagram.com",), r"/stories/(?!highlights/)(?P<arg>[\w.]+)", backends=(instaloader,), image=True, album=True, needs_auth=True)
+async def download_instagram_stories(username: str) -> AsyncIterator:
+    items = await engine.run("Instagram", _instagram_story_items, username, False)
+    return download_album(items, "Instagram") if items else "لم يتم العثور على stories."
+
+@extractors.register("Instagram Highlights", "Instagram", ("instagram.com",), r"/(?:stories/)?highlights/(?P<arg>[\w.]+)", backends=(instaloader,), image=True, album=True, needs_auth=True)
+async def download_instagram_highlights(username: str) -> AsyncIterator:
+    items = await engine.run("Instagram", _instagram_story_items, username, True)
+    return download_album(items, "Instagram") if items else "لم يتم العثور على highlights."
+
+async def expand_short_url(short_url: str) -> str:
+    try:
+        return await http.resolve(short_url)
     except:
         return None
 
 async def get_download_url(link: str) -> str:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post('https://www.expertsphp.com/download.php', data={'url': link}) as response:
-                return pq(await response.text())('table.table-condensed')('tbody')('td')('a').attr('href')
+        with stage("pinterest_resolve", "Pinterest"):
+            html = await http.text("POST", PINTEREST_RESOLVER, data={'url': link})
+        return pyquery.PyQuery(html)('table.table-condensed')('tbody')('td')('a').attr('href')
     except:
         return None
 
-async def download_video(url: str) -> BytesIO:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return named_bytesio(await response.read())
-            return f"Failed: {response.status}"
+async def download_video(url: str, platform: str) -> MediaFile:
+    return await fetch_direct(url, platform)
+
+async def fetch_direct(url: str, platform: str) -> MediaFile:
+    temp_dir = tempfile.mkdtemp()
+    media = MediaFile(os.path.join(temp_dir, os.path.basename(urlsplit(url).path) or "vid.mp4"), temp_dir)
+    try:
+        with stage("direct_download", platform):
+            await http.download(url, media.path, MAX_FILE_SIZE, progress_reporter.get(), lambda: announce_stream(media.path))
+        return media
+    except aiohttp.ClientResponseError as e:
+        media.close()
+        return f"Failed: {e.status}"
+    except BaseException:
+        media.close()
+        raise
+
+async def download_image(url: str, platform: str) -> MediaFile:
+    return await download_video(url, platform)
+
+@extractors.register("Pinterest", "Pinterest", ("pinterest.com", "pin.it"), r"/", backends=(pyquery,), image=True)
+async def download_pinterest(url: str) -> tuple:
+    download_url = await get_download_url(url)
+    if not download_url:
+        return 'فشل في الحصول على رابط التحميل من Pinterest.', "Pinterest", False
+    is_video = '.mp4' in download_url
+    media_data = await download_video(download_url, "Pinterest") if is_video else await download_image(download_url, "Pinterest")
+    return media_data, "Pinterest Video" if is_video else "Pinterest Image", is_video
 
-async def download_image(url: str) -> BytesIO:
-    return await download_video(url)
+@extractors.register("Instagram", "Instagram", ("instagram.com",), r"/")
+async def unsupported_instagram(url: str) -> str:
+    return 'رابط Instagram غير مدعوم.'
 
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+@routes.get('/')
+async def index(request: web.Request):
+    return web.Response(text=HTML_TEMPLATE, content_type='text/html')
 
 EXECUTE_HTML = """
 <!DOCTYPE html>
@@ -420,67 +1916,253 @@ EXECUTE_HTML = """
 </html>
 """
 
-@app.route('/execute')
-def execute_page():
-    return render_template_string(EXECUTE_HTML)
+@routes.get('/execute')
+async def execute_page(request: web.Request):
+    return web.Response(text=EXECUTE_HTML, content_type='text/html')
 
-@app.route('/execute', methods=['POST'])
-def execute_command():
+@routes.post('/execute')
+async def execute_command(request: web.Request):
     try:
-        command = request.get_json().get('command')
+        command = (await request.json()).get('command')
         if not command:
-            return jsonify({'error': 'No command provided'}), 400
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-        return jsonify({'output': result.stdout + result.stderr, 'returncode': result.returncode})
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Command timeout'}), 408
+            return web.json_response({'error': 'No command provided'}, status=400)
+        process = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
+        except asyncio.TimeoutError:
+            process.kill()
+            return web.json_response({'error': 'Command timeout'}, status=408)
+        return web.json_response({'output': (stdout + stderr).decode(errors='replace'), 'returncode': process.returncode})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
+
+async def get_web_media(url: str) -> dict:
+    result = await get_media(url)
+    if result['success'] and 'album' in result:
+        album = result.pop('album')
+        try:
+            async for media, is_video in album:
+                return {**result, 'data': media, 'is_video': is_video}
+        finally:
+            await album.aclose()
+        return {'success': False, 'error': 'حدث خطأ أثناء التحميل.'}
+    return result
+
+async def stream_growing_file(request: web.Request, f, task: asyncio.Task) -> tuple:
+    response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream', 'Content-Disposition': 'attachment; filename="vid.mp4"'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    sent = 0
+    while True:
+        chunk = await asyncio.to_thread(f.read, 256 * 1024)
+        if chunk:
+            await response.write(chunk)
+            sent += len(chunk)
+        elif task.done():
+            return response, sent
+        else:
+            await asyncio.sleep(0.2)
+
+class MediaFileResponse(web.FileResponse):
+    def __init__(self, media: MediaFile, platform: str, **kwargs):
+        super().__init__(media.path, **kwargs)
+        self.media = media
+        self.platform = platform
+        self.size = media.size
 
-@app.route('/download', methods=['POST'])
-def download():
+    async def prepare(self, request: web.BaseRequest):
+        try:
+            with stage("web_send", self.platform):
+                writer = await super().prepare(request)
+            metrics.inc("bytes_served_total", self.size)
+            return writer
+        finally:
+            self.media.close()
+
+async def open_when_created(path: str, task: asyncio.Task):
+    while not task.done():
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            await asyncio.sleep(0.1)
+    return None
+
+def client_ip(request: web.Request) -> str:
+    if TRUST_PROXY and 'X-Forwarded-For' in request.headers:
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote
+
+@routes.post('/download')
+async def download(request: web.Request):
+    with traced("web_download", path=request.path), metrics.in_flight("web_requests_in_flight"):
+        response = await serve_download(request)
+    metrics.inc("web_responses_total", status=response.status)
+    return response
+
+async def serve_download(request: web.Request):
     try:
-        url = request.get_json().get('url')
+        url = (await request.json()).get('url')
         if not url:
-            return jsonify({'error': 'يرجى تقديم رابط'}), 400
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(process_download(url))
-        loop.close()
+            return web.json_response({'error': 'يرجى تقديم رابط'}, status=400)
+        retry_after, user_limited = await rate_limiter.check(f"web:{client_ip(request)}", platform_name(url))
+        if retry_after:
+            error = 'لقد تجاوزت حد 5 تحميلات في الدقيقة. يرجى الانتظار.' if user_limited else 'الخادم مشغول حاليًا، يرجى المحاولة بعد قليل.'
+            return web.json_response({'error': error}, status=429, headers={'Retry-After': str(int(retry_after) + 1)})
+        target = asyncio.get_running_loop().create_future()
+        token = stream_target.set(target)
+        task = asyncio.ensure_future(get_web_media(url))
+        stream_target.reset(token)
+        try:
+            await asyncio.wait([task, target], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        f = await open_when_created(target.result(), task) if target.done() else None
+        if f:
+            try:
+                with f, stage("web_stream", platform_name(url) or "unknown"):
+                    response, sent = await stream_growing_file(request, f, task)
+                metrics.inc("bytes_served_total", sent)
+            except BaseException:
+                task.cancel()
+                raise
+            result = task.result()
+            if not result['success'] or result['data'].size != sent:
+                logging.error(f"Error streaming {url}: {result.get('error', 'incomplete file')}")
+                request.transport.abort()
+            if result['success']:
+                result['data'].close()
+            return response
+        result = await task
         if result['success']:
-            media_data = result['data']
-            if not check_data_size(media_data.getvalue()):
-                media_data.close()
-                return jsonify({'error': 'حجم الملف يتجاوز حد 50 ميجابايت'}), 400
-            media_data.seek(0)
-            return send_file(media_data, mimetype='video/mp4' if result['is_video'] else 'image/jpeg', as_attachment=True, download_name='vid.mp4')
-        return jsonify({'error': result['error']}), 400
+            media = result['data']
+            try:
+                if not check_data_size(media.size):
+                    metrics.inc("oversized_rejections_total", platform=platform_name(url) or "unknown")
+                    media.close()
+                    return web.json_response({'error': 'حجم الملف يتجاوز حد 50 ميجابايت'}, status=400)
+                return MediaFileResponse(media, platform_name(url) or "unknown", headers={'Content-Type': 'video/mp4' if result['is_video'] else 'image/jpeg', 'Content-Disposition': 'attachment; filename="vid.mp4"'})
+            except BaseException:
+                media.close()
+                raise
+        return web.json_response({'error': result['error']}, status=400)
     except Exception as e:
         logging.error(f"Error: {e}")
-        return jsonify({'error': 'حدث خطأ أثناء معالجة الطلب'}), 500
+        return web.json_response({'error': 'حدث خطأ أثناء معالجة الطلب'}, status=500)
 
-def run_flask():
-    app.run(host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False)
+def job_status(job: dict) -> dict:
+    ref = f"{job['id']}-{job['token']}"
+    status = {'id': ref, 'url': job['url'], 'status': job['state']}
+    if job['state'] == 'done':
+        status['file'] = f"/download/jobs/{ref}/file"
+    elif job['error']:
+        status['error'] = job['error']
+    return status
 
-def main():
-    logging.info("Starting application...")
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logging.info(f"Flask started on port {FLASK_PORT}")
-    
-    # scheduler = BackgroundScheduler()
-    # scheduler.add_job(check_pair_site_availability, 'interval', minutes=1)
-    # scheduler.start()
-    
+def find_web_job(ref: str) -> dict:
+    job_id, _, token = ref.partition('-')
+    job = job_queue.get(int(job_id)) if job_id.isdigit() else None
+    if job and job['kind'] == 'web' and hmac.compare_digest(job['token'] or '', token):
+        return job
+    return None
+
+@routes.post('/download/batch')
+async def download_batch(request: web.Request):
     try:
-        if BOT_TOKEN and API_ID and API_HASH:
-            bot.run()
+        urls = (await request.json()).get('urls')
+    except (ValueError, AttributeError):
+        urls = None
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) and url.strip() for url in urls):
+        return web.json_response({'error': 'يرجى تقديم قائمة روابط'}, status=400)
+    if len(urls) > BATCH_MAX_URLS:
+        return web.json_response({'error': f'الحد الأقصى {BATCH_MAX_URLS} روابط في الطلب الواحد'}, status=400)
+    user = f"web:{client_ip(request)}"
+    jobs = []
+    for url in urls:
+        retry_after, user_limited = await rate_limiter.check(user, platform_name(url))
+        if retry_after:
+            error = 'لقد تجاوزت حد 5 تحميلات في الدقيقة. يرجى الانتظار.' if user_limited else 'الخادم مشغول حاليًا، يرجى المحاولة بعد قليل.'
+            jobs.append({'url': url, 'status': 'rejected', 'error': error, 'retry_after': int(retry_after) + 1})
+            continue
+        job_id = job_queue.enqueue(user, None, None, None, url.strip(), kind='web', token=secrets.token_urlsafe(12))
+        jobs.append(job_status(job_queue.get(job_id)))
+    metrics.inc("web_batch_items_total", len(jobs))
+    return web.json_response({'jobs': jobs}, status=202)
+
+@routes.get('/download/jobs/{job}')
+async def download_job(request: web.Request):
+    job = find_web_job(request.match_info['job'])
+    if not job:
+        return web.json_response({'error': 'المهمة غير موجودة'}, status=404)
+    return web.json_response(job_status(job))
+
+@routes.get('/download/jobs/{job}/file')
+async def download_job_file(request: web.Request):
+    job = find_web_job(request.match_info['job'])
+    if not job:
+        return web.json_response({'error': 'المهمة غير موجودة'}, status=404)
+    if job['state'] != 'done' or not job['result'] or not os.path.exists(job['result']):
+        return web.json_response(job_status(job), status=409)
+    metrics.inc("bytes_served_total", os.path.getsize(job['result']))
+    return web.FileResponse(job['result'], headers={'Content-Disposition': f'attachment; filename="{os.path.basename(job["result"])}"'})
+
+web_app = web.Application()
+web_app.add_routes(routes)
+
+startup_timings["module_load"] = round(time.perf_counter() - BOOT_STARTED, 3)
+
+def mark_ready(name: str):
+    startup_timings[name] = round(time.perf_counter() - BOOT_STARTED, 3)
+    logging.info(f"{name} after {startup_timings[name]}s")
+
+async def warm_up():
+    for name in WARMUP_BACKENDS:
+        try:
+            await asyncio.to_thread(BACKENDS[name].load)
+        except Exception as e:
+            logging.error(f"Warm-up of {name} failed: {e!r}")
+    if WARMUP_BACKENDS:
+        mark_ready("warm_up_done")
+
+async def serve(with_bot: bool = True):
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', WEB_PORT, reuse_port=WEB_WORKERS > 1).start()
+    logging.info(f"Web server started on port {WEB_PORT} (pid {os.getpid()})")
+    mark_ready("web_ready")
+    warmup = asyncio.ensure_future(warm_up())
+
+    try:
+        if with_bot and BOT_TOKEN and API_ID and API_HASH:
+            await bot.start()
+            mark_ready("bot_ready")
+            workers = asyncio.ensure_future(job_queue.run(process_job, JOB_WORKERS))
+            mirror = asyncio.ensure_future(channel_mirror.run())
+            await idle()
+            workers.cancel()
+            mirror.cancel()
+            await bot.stop()
         else:
-            logging.warning("Bot credentials not set. Running web server only.")
-            flask_thread.join()
+            if with_bot:
+                logging.warning("Bot credentials not set. Running web server only.")
+                await job_queue.run(process_job, JOB_WORKERS)
+            await asyncio.Event().wait()
     finally:
-        pass
-        # scheduler.shutdown()
+        warmup.cancel()
+        await runner.cleanup()
+        await http.close()
+
+def run_web_worker():
+    job_queue.db = job_queue.connect()
+    media_cache.db = media_cache.connect()
+    media_cache.readonly = True
+    asyncio.run(serve(with_bot=False))
+
+def main():
+    logging.info("Starting application...")
+    for _ in range(WEB_WORKERS - 1):
+        multiprocessing.Process(target=run_web_worker, daemon=True).start()
+    bot.run(serve())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp())
+main = pytest.importorskip("main")
+
+
+def key(url: str) -> str:
+    return main.cache_key(main.canonical_url(url))
+
+
+def test_media_ids():
+    assert key("https://youtu.be/dQw4w9WgXcQ?si=abc") == "youtube:dQw4w9WgXcQ"
+    assert key("https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ") == "youtube:dQw4w9WgXcQ"
+    assert key("https://www.tiktok.com/@user/video/123") == "tiktok:123"
+    assert key("https://www.instagram.com/reel/ABC_1/") == "instagram:ABC_1"
+
+
+def test_id_from_another_platform_in_path_is_ignored():
+    assert key("https://www.tiktok.com/@attacker/video/1/youtu.be/dQw4w9WgXcQ") == "tiktok:1"
+    assert not key("https://www.tiktok.com/@attacker/youtube.com/watch?v=dQw4w9WgXcQ").startswith("youtube:")
+    assert not key("https://example.com/youtu.be/dQw4w9WgXcQ").startswith("youtube:")
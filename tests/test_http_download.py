@@ -0,0 +1,86 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp())
+main = pytest.importorskip("main")
+from aiohttp import web
+
+DATA = os.urandom(1024 * 1024 + 123)
+RANGES = web.AppKey("ranges", list)
+
+
+async def serve_media(request: web.Request):
+    mode = request.match_info["mode"]
+    header = request.headers.get("Range", "")
+    request.app[RANGES].append(header)
+    if mode == "plain":
+        return web.Response(body=DATA)
+    if mode == "chunked":
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await response.write(DATA)
+        return response
+    start, _, end = header[len("bytes="):].partition("-")
+    start, end = int(start), int(end or len(DATA) - 1)
+    part = DATA[start:end + 1]
+    response = web.StreamResponse(status=206, headers={"Content-Range": f"bytes {start}-{end}/{len(DATA)}", "Accept-Ranges": "bytes"})
+    response.content_length = len(part)
+    await response.prepare(request)
+    if mode == "flaky" and len(request.app[RANGES]) == 1:
+        await response.write(part[:100000])
+        request.transport.close()
+        return response
+    await response.write(part)
+    return response
+
+
+def download(mode: str, max_bytes: int = main.MAX_FILE_SIZE, range_parts: int = 4) -> tuple:
+    async def run():
+        app = web.Application()
+        app[RANGES] = []
+        app.router.add_get("/{mode}", serve_media)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = main.HttpClient(8, 8, 10, 0, range_parts, 256 * 1024, 2)
+        path = os.path.join(tempfile.mkdtemp(), "vid.mp4")
+        try:
+            received = await client.download(f"http://127.0.0.1:{port}/{mode}", path, max_bytes)
+            with open(path, "rb") as f:
+                return received, f.read(), app[RANGES]
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_parallel_ranges():
+    received, body, ranges = download("ranged")
+    assert received == len(DATA) and body == DATA
+    assert len(ranges) == 5
+
+
+def test_server_without_ranges():
+    received, body, ranges = download("plain")
+    assert received == len(DATA) and body == DATA
+    assert ranges == ["bytes=0-"]
+
+
+def test_resume_after_dropped_connection():
+    received, body, ranges = download("flaky", range_parts=1)
+    assert received == len(DATA) and body == DATA
+    assert ranges == ["bytes=0-", f"bytes=100000-{len(DATA) - 1}"]
+
+
+@pytest.mark.parametrize("mode", ["ranged", "plain", "chunked"])
+def test_size_cap(mode):
+    with pytest.raises(main.MediaTooLarge):
+        download(mode, max_bytes=len(DATA) - 1)
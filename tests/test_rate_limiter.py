@@ -0,0 +1,43 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp())
+main = pytest.importorskip("main")
+
+
+def test_gcra_admits_burst_then_spaces_requests():
+    backend = main.MemoryRateBackend()
+    quota = [("k", 30.0, 30.0)]
+
+    def acquire(now: float) -> tuple:
+        return asyncio.run(backend.acquire(quota, now))
+
+    assert acquire(0) == (0, None)
+    assert acquire(0) == (0, None)
+    assert acquire(0) == (30.0, "k")
+    assert acquire(29) == (1.0, "k")
+    assert acquire(30) == (0, None)
+
+
+def test_rejected_request_charges_no_quota(monkeypatch):
+    backend = main.MemoryRateBackend()
+    limiter = main.RateLimiter(backend, 2, {"YouTube": 1}, 100)
+    monkeypatch.setattr(main.time, "time", lambda: 1000.0)
+
+    def check(user: str, platform: str = None) -> tuple:
+        return asyncio.run(limiter.check(user, platform))
+
+    assert check("a", "YouTube") == (0, False)
+    retry_after, user_limited = check("b", "YouTube")
+    assert retry_after > 0 and not user_limited
+    assert "rl:user:b" not in backend.tats
+    assert backend.tats["rl:global"] == pytest.approx(1000.6)
+
+    assert check("a") == (0, False)
+    retry_after, user_limited = check("a")
+    assert retry_after > 0 and user_limited
+    assert backend.tats["rl:global"] == pytest.approx(1001.2)
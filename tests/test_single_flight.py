@@ -0,0 +1,97 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp())
+main = pytest.importorskip("main")
+
+
+def media_result() -> dict:
+    temp_dir = tempfile.mkdtemp()
+    path = os.path.join(temp_dir, "vid.mp4")
+    open(path, "wb").close()
+    return {"success": True, "data": main.MediaFile(path, temp_dir)}
+
+
+def test_followers_share_one_refcounted_result():
+    async def run():
+        flight = main.SingleFlight(main.share_result, main.release_result)
+        calls = []
+        gate = asyncio.Event()
+
+        async def fetch():
+            calls.append(1)
+            await gate.wait()
+            return media_result()
+
+        tasks = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        media = results[0]["data"]
+        assert len(calls) == 1
+        assert all(result["data"] is media for result in results)
+        assert media.refs == 3
+        for result in results:
+            result["data"].close()
+        assert not os.path.exists(os.path.dirname(media.path))
+
+    asyncio.run(run())
+
+
+def test_follower_takes_over_after_leader_cancel():
+    async def run():
+        flight = main.SingleFlight(main.share_result, main.release_result)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            if len(calls) == 1:
+                await asyncio.Event().wait()
+            return media_result()
+
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await follower
+        assert leader.cancelled()
+        assert len(calls) == 2
+        assert result["data"].refs == 1
+        result["data"].close()
+        assert not flight.calls
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_releases_its_share():
+    async def run():
+        flight = main.SingleFlight(main.share_result, main.release_result)
+        gate = asyncio.Event()
+
+        async def fetch():
+            await gate.wait()
+            return media_result()
+
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        result = await leader
+        media = result["data"]
+        assert (await waiters[1])["data"] is media
+        await asyncio.sleep(0)
+        assert waiters[0].cancelled()
+        assert media.refs == 2
+        media.close()
+        media.close()
+        assert not os.path.exists(os.path.dirname(media.path))
+
+    asyncio.run(run())